@@ -10,56 +10,202 @@ WebRTC Video Streaming Server
 - 实时统计信息
 """
 
-import json
+import asyncio
 import logging
-import random
-import string
+import multiprocessing
+import os
+import secrets
+import struct
 import time
-import uuid
-from typing import Dict, Set, Optional
+from typing import Container, Dict, Iterable, List, Set, Tuple, Optional
 from dataclasses import dataclass, field
 
+import msgspec
+import orjson
 from aiohttp import web
 from aiohttp.web import WebSocketResponse
 import aiohttp_cors
 
+try:
+    # 可选：uvloop 提供更快的事件循环（不支持Windows）
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 每个观看者转发队列的最大帧数，满时丢弃最旧的帧
+RELAY_QUEUE_SIZE = 4
+# 典型的转发视频帧大小，用于推导流控水位
+RELAY_TYPICAL_FRAME_SIZE = 30 * 1024
+# 平均每个非慢消费者观看者积压字节数的高/低水位，用于向主播发送暂停/恢复信号。
+# 单个慢观看者由队列丢弃最旧帧处理；只有多数观看者同时积压（整体出口带宽饱和）才暂停
+MAX_RELAY_BACKLOG = (RELAY_QUEUE_SIZE // 2) * RELAY_TYPICAL_FRAME_SIZE
+RELAY_BACKLOG_LOW_WATERMARK = RELAY_TYPICAL_FRAME_SIZE // 2
+# 暂停超过该秒数后，仍有积压的观看者被视为慢消费者，保证主播能够恢复
+FLOW_CONTROL_MAX_PAUSE = 1.0
+
+
+def dumps(obj) -> str:
+    """使用orjson序列化JSON消息"""
+    return orjson.dumps(obj).decode()
+
+
+# 可选的二进制信令子协议：控制消息使用msgpack编码，通过二进制帧传输
+MSGPACK_PROTOCOL = "msgpack-v1"
+
+
+def is_msgpack_map(data: bytes) -> bool:
+    """判断二进制帧是否为msgpack编码的控制消息
+
+    控制消息总是map（fixmap 0x80-0x8f 或 map16/map32），
+    视频帧以0x00/0x01（WebCodecs）或0xFF（JPEG）开头，不会混淆。
+    """
+    return bool(data) and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf))
+
+
+# 转发视频帧时只构造一次WebSocket帧，直接写入各观看者的传输层
+# （依赖aiohttp内部实现，不可用时回退到send_bytes）
+RELAY_PREFRAMED = True
+# 统计汇总发送给主播的最小间隔（秒），期间的更新合并为一次
+STATS_FLUSH_INTERVAL = 0.5
+# ICE候选合并转发的时间窗口（秒）
+ICE_BATCH_INTERVAL = 0.02
+# 粗粒度时钟的更新间隔（秒）
+CLOCK_TICK_INTERVAL = 0.1
+
+
+def frame_binary(data: bytes) -> bytes:
+    """构造服务器发往客户端的二进制帧
+
+    服务器帧不加掩码，且视频帧不压缩（RSV1为0，不影响permessage-deflate上下文），
+    因此同一帧可原样发给所有观看者。
+    """
+    length = len(data)
+    if length < 126:
+        header = struct.pack("!BB", 0x82, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x82, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x82, 127, length)
+    return header + data
+
+
+# 6位数字房间ID空间大小
+ROOM_ID_SPACE = 1_000_000
 
-def generate_room_id() -> str:
-    """生成6位数字房间ID"""
-    return ''.join(random.choices(string.digits, k=6))
 
+def generate_room_id(used: Container[str], shard: int = 0, shards: int = 1) -> str:
+    """生成未被占用的6位数字房间ID（随机起点 + 线性探测）
 
-@dataclass
-class ViewerStats:
-    """观看者统计信息"""
+    多进程模式下只在本进程的分片内分配：int(room_id) % shards == shard。
+    """
+    count = (ROOM_ID_SPACE - shard + shards - 1) // shards
+    start = secrets.randbelow(count)
+    for offset in range(count):
+        room_id = f"{((start + offset) % count) * shards + shard:06d}"
+        if room_id not in used:
+            return room_id
+    raise RuntimeError("房间ID已用尽")
+
+
+def shard_port(port: int, shard: int) -> int:
+    """多进程模式下工作进程的私有端口"""
+    return port + 1 + shard
+
+
+class SPSCRing:
+    """单生产者单消费者的定长环形缓冲区
+
+    生产者从不等待：缓冲区满时覆盖最旧的元素并将其返回。
+    消费者在缓冲区为空时等待 not_empty 事件。
+    """
+    __slots__ = ("capacity", "buf", "head", "tail", "not_empty")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buf: List = [None] * capacity
+        self.head = 0
+        self.tail = 0
+        self.not_empty = asyncio.Event()
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def push(self, item):
+        """放入元素，缓冲区满时返回被丢弃的最旧元素，否则返回None"""
+        dropped = None
+        if len(self) == self.capacity:
+            index = self.head % self.capacity
+            dropped = self.buf[index]
+            self.head += 1
+        self.buf[self.tail % self.capacity] = item
+        self.tail += 1
+        self.not_empty.set()
+        return dropped
+
+    async def pop(self):
+        """取出最旧的元素，缓冲区为空时等待"""
+        while self.head == self.tail:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        index = self.head % self.capacity
+        item = self.buf[index]
+        self.buf[index] = None
+        self.head += 1
+        return item
+
+
+@dataclass(slots=True)
+class Viewer:
+    """观看者连接及统计信息"""
     client_id: str
+    ws: WebSocketResponse
     connected_at: float = field(default_factory=time.time)
     bytes_sent: int = 0
     is_p2p: bool = False
     bitrate: float = 0.0
+    # 服务器转发发送队列及其发送协程
+    out_queue: SPSCRing = field(default_factory=lambda: SPSCRing(RELAY_QUEUE_SIZE))
+    writer_task: Optional[asyncio.Task] = None
+    queued_bytes: int = 0
+    dropped_frames: int = 0
+    # 慢消费者（队列已满或暂停期间无进展）不计入房间积压，队列清空后恢复
+    stalled: bool = False
+    # 自上次统计发送后是否有变化
+    dirty: bool = True
+    # 队列中是否为预先构造好的WebSocket帧
+    preframed: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class BroadcastRoom:
     """直播房间"""
     room_id: str
     broadcaster_ws: Optional[WebSocketResponse] = None
     broadcaster_id: str = ""
-    viewers: Dict[str, WebSocketResponse] = field(default_factory=dict)
-    viewer_stats: Dict[str, ViewerStats] = field(default_factory=dict)
+    viewers: Dict[str, Viewer] = field(default_factory=dict)
     created_at: float = field(default_factory=time.time)
     total_bytes_sent: int = 0
     current_bitrate: float = 0.0
     # 服务器转发相关
     relay_connections: Set[str] = field(default_factory=set)
+    # relay观看者快照，仅在加入/离开/启用转发时重建，避免每帧查找
+    relay_viewers: Tuple[Viewer, ...] = ()
+    # 非慢消费者观看者队列中待发送的字节数及流控状态
+    relay_backlog: int = 0
+    relay_paused: bool = False
+    flow_timeout_task: Optional[asyncio.Task] = None
     # 存储最新的视频帧用于服务器转发
     latest_frame: Optional[bytes] = None
+    # 单调时钟时间，精度为CLOCK_TICK_INTERVAL
     frame_timestamp: float = 0.0
     # 编解码器配置
     codec_config: Optional[dict] = None
+    # 统计汇总合并发送
+    stats_dirty: bool = False
+    stats_flush_task: Optional[asyncio.Task] = None
 
 
 class WebRTCSignalingServer:
@@ -94,14 +240,64 @@ class WebRTCSignalingServer:
         }
     ]
     
-    def __init__(self):
+    def __init__(self, debug: bool = False, shard: int = 0, shards: int = 1, port: int = 8080,
+                 redirect_url: str = ""):
+        # 调试模式下每次请求重新读取主页面，便于修改前端
+        self.debug = debug
+        # 多进程模式下本进程负责的房间分片，以及公共端口（用于计算其他分片的私有端口）
+        self.shard = shard
+        self.shards = shards
+        self.port = port
+        # 重定向地址模板（可含 {shard}/{port}），用于反向代理或TLS终止之后的部署；
+        # 为空时客户端使用当前页面的主机名和私有端口
+        self.redirect_url = redirect_url
+        self._index_bytes = self._read_index()
         self.rooms: Dict[str, BroadcastRoom] = {}
         self.client_to_room: Dict[str, str] = {}
         self.websockets: Dict[str, WebSocketResponse] = {}
+        # ICE服务器配置不变，预先序列化
+        self._ice_servers_body = orjson.dumps({"iceServers": self.ICE_SERVERS})
+        # client_id 字段位于ice_servers之前，替换首个占位即可
+        self._welcome_template = dumps({
+            "type": "welcome",
+            "client_id": "",
+            "ice_servers": self.ICE_SERVERS
+        })
+        # 粗粒度单调时钟，由后台任务定期更新，避免每帧调用time()
+        self._now = time.monotonic()
+        self._clock_task: Optional[asyncio.Task] = None
+        # 待合并转发的ICE候选: (from_id, target_id) -> 消息列表
+        self._pending_ice: Dict[Tuple[str, str], List[dict]] = {}
+        self._ice_flush_task: Optional[asyncio.Task] = None
         self.app = web.Application()
+        self.app.on_startup.append(self._start_clock)
+        self.app.on_cleanup.append(self._stop_clock)
+        self.app.on_cleanup.append(self._stop_ice_flush)
         self._setup_routes()
         self._setup_cors()
         
+    async def _start_clock(self, app: web.Application):
+        """启动粗粒度时钟任务"""
+        self._clock_task = asyncio.create_task(self._tick())
+
+    async def _stop_clock(self, app: web.Application):
+        """停止粗粒度时钟任务"""
+        if self._clock_task:
+            self._clock_task.cancel()
+            self._clock_task = None
+
+    async def _stop_ice_flush(self, app: web.Application):
+        """停止ICE候选合并转发任务"""
+        if self._ice_flush_task:
+            self._ice_flush_task.cancel()
+            self._ice_flush_task = None
+
+    async def _tick(self):
+        """定期更新粗粒度时钟"""
+        while True:
+            self._now = time.monotonic()
+            await asyncio.sleep(CLOCK_TICK_INTERVAL)
+
     def _setup_routes(self):
         """设置路由"""
         self.app.router.add_get('/', self.index_handler)
@@ -127,13 +323,18 @@ class WebRTCSignalingServer:
 
     async def index_handler(self, request: web.Request) -> web.Response:
         """主页面处理"""
-        with open('static/index.html', 'r', encoding='utf-8') as f:
-            content = f.read()
-        return web.Response(text=content, content_type='text/html')
+        body = self._read_index() if self.debug else self._index_bytes
+        return web.Response(body=body, content_type='text/html', charset='utf-8')
+
+    @staticmethod
+    def _read_index() -> bytes:
+        """读取主页面"""
+        with open('static/index.html', 'rb') as f:
+            return f.read()
     
     async def ice_servers_handler(self, request: web.Request) -> web.Response:
         """返回ICE服务器配置"""
-        return web.json_response({"iceServers": self.ICE_SERVERS})
+        return web.Response(body=self._ice_servers_body, content_type='application/json')
     
     async def list_rooms_handler(self, request: web.Request) -> web.Response:
         """列出活跃房间"""
@@ -145,32 +346,40 @@ class WebRTCSignalingServer:
                     "viewers": len(room.viewers),
                     "created_at": room.created_at
                 })
-        return web.json_response({"rooms": rooms_info})
+        return web.json_response({"rooms": rooms_info}, dumps=dumps)
 
     async def websocket_handler(self, request: web.Request) -> WebSocketResponse:
         """WebSocket连接处理"""
-        ws = WebSocketResponse()
+        ws = WebSocketResponse(protocols=(MSGPACK_PROTOCOL,))
         await ws.prepare(request)
         
-        client_id = str(uuid.uuid4())[:8]
+        client_id = secrets.token_hex(4)
         self.websockets[client_id] = ws
         
         logger.info(f"新客户端连接: {client_id}")
         
-        # 发送客户端ID和ICE服务器配置
-        await ws.send_json({
-            "type": "welcome",
-            "client_id": client_id,
-            "ice_servers": self.ICE_SERVERS
-        })
+        # 发送客户端ID和ICE服务器配置（client_id为十六进制，可直接填入模板）
+        if ws.ws_protocol == MSGPACK_PROTOCOL:
+            await self._send(ws, {
+                "type": "welcome",
+                "client_id": client_id,
+                "ice_servers": self.ICE_SERVERS
+            })
+        else:
+            await ws.send_str(self._welcome_template.replace(
+                '"client_id":""', '"client_id":"%s"' % client_id, 1))
         
         try:
             async for msg in ws:
                 if msg.type == web.WSMsgType.TEXT:
-                    await self._handle_message(client_id, ws, json.loads(msg.data))
+                    await self._handle_message(client_id, ws, orjson.loads(msg.data))
                 elif msg.type == web.WSMsgType.BINARY:
-                    # 处理二进制数据（服务器转发模式的视频帧）
-                    await self._handle_binary(client_id, msg.data)
+                    if ws.ws_protocol == MSGPACK_PROTOCOL and is_msgpack_map(msg.data):
+                        await self._handle_message(
+                            client_id, ws, msgspec.msgpack.decode(msg.data))
+                    else:
+                        # 处理二进制数据（服务器转发模式的视频帧）
+                        await self._handle_binary(client_id, msg.data)
                 elif msg.type == web.WSMsgType.ERROR:
                     logger.error(f"WebSocket错误: {ws.exception()}")
         except Exception as e:
@@ -230,26 +439,146 @@ class WebRTCSignalingServer:
             
         # 存储最新帧并转发给需要服务器转发的观看者
         room.latest_frame = data
-        room.frame_timestamp = time.time()
+        room.frame_timestamp = self._now
         room.total_bytes_sent += len(data)
         
-        # 转发给所有relay连接的观看者
-        for viewer_id in list(room.relay_connections):
-            if viewer_id in room.viewers:
-                try:
-                    await room.viewers[viewer_id].send_bytes(data)
-                    if viewer_id in room.viewer_stats:
-                        room.viewer_stats[viewer_id].bytes_sent += len(data)
-                except Exception as e:
-                    logger.error(f"转发帧到 {viewer_id} 失败: {e}")
-                    room.relay_connections.discard(viewer_id)
+        # 放入所有relay连接观看者的发送队列，队列满时丢弃最旧的帧
+        # 队列元素为 (负载数据, 预构造帧或None)，统计不包含WebSocket帧头
+        size = len(data)
+        raw = (data, None)
+        framed = None
+        for viewer in room.relay_viewers:
+            if viewer.preframed:
+                if framed is None:
+                    framed = (data, frame_binary(data))
+                item = framed
+            else:
+                item = raw
+            queue = viewer.out_queue
+            dropped = queue.push(item)
+            if dropped is not None:
+                dropped_size = len(dropped[0])
+                viewer.queued_bytes -= dropped_size
+                if not viewer.stalled:
+                    room.relay_backlog -= dropped_size
+                viewer.dropped_frames += 1
+            viewer.queued_bytes += size
+            if not viewer.stalled:
+                room.relay_backlog += size
+                if len(queue) == queue.capacity:
+                    # 队列已满，视为慢消费者，避免其积压暂停整个房间
+                    self._mark_stalled(room, viewer)
+            
+        await self._update_flow_control(room)
+
+    async def _viewer_writer(self, room: BroadcastRoom, viewer: Viewer):
+        """观看者发送协程：从队列取出视频帧并发送"""
+        try:
+            while True:
+                data, frame = await viewer.out_queue.pop()
+                if frame is not None and viewer.preframed:
+                    try:
+                        await self._write_preframed(viewer.ws, frame)
+                    except Exception as e:
+                        # 直接写入失败（如aiohttp内部实现变化），回退到send_bytes
+                        logger.warning(f"预构造帧写入 {viewer.client_id} 失败，回退到send_bytes: {e}")
+                        viewer.preframed = False
+                        await viewer.ws.send_bytes(data)
+                else:
+                    await viewer.ws.send_bytes(data)
+                size = len(data)
+                viewer.bytes_sent += size
+                viewer.dirty = True
+                viewer.queued_bytes -= size
+                if viewer.stalled:
+                    if not len(viewer.out_queue):
+                        # 已追上，重新计入房间积压
+                        viewer.stalled = False
+                else:
+                    room.relay_backlog -= size
+                if room.relay_paused:
+                    await self._update_flow_control(room)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"转发帧到 {viewer.client_id} 失败: {e}")
+            await self._leave_room(viewer.client_id)
+
+    @staticmethod
+    def _supports_preframed(ws: WebSocketResponse) -> bool:
+        """是否可以绕过aiohttp直接写入预先构造的帧"""
+        writer = getattr(ws, "_writer", None)
+        return (RELAY_PREFRAMED and writer is not None
+                and hasattr(writer, "transport")
+                and hasattr(getattr(writer, "protocol", None), "_drain_helper"))
+
+    @staticmethod
+    async def _write_preframed(ws: WebSocketResponse, frame: bytes):
+        """直接写入预先构造的帧，写缓冲区满时等待排空"""
+        writer = ws._writer
+        if ws.closed or writer.transport.is_closing():
+            raise ConnectionResetError("Cannot write to closing transport")
+        writer.transport.write(frame)
+        if writer.protocol._paused:
+            await writer.protocol._drain_helper()
+
+    @staticmethod
+    def _mark_stalled(room: BroadcastRoom, viewer: Viewer):
+        """将观看者标记为慢消费者，并将其积压移出房间统计"""
+        if not viewer.stalled:
+            viewer.stalled = True
+            room.relay_backlog -= viewer.queued_bytes
+
+    async def _update_flow_control(self, room: BroadcastRoom):
+        """根据转发积压量向主播发送暂停/恢复信号"""
+        healthy = sum(1 for viewer in room.relay_viewers if not viewer.stalled)
+        if not room.relay_paused and room.relay_backlog > healthy * MAX_RELAY_BACKLOG:
+            room.relay_paused = True
+            room.flow_timeout_task = asyncio.create_task(self._flow_pause_timeout(room))
+            action = "pause"
+        elif room.relay_paused and room.relay_backlog <= healthy * RELAY_BACKLOG_LOW_WATERMARK:
+            room.relay_paused = False
+            if room.flow_timeout_task:
+                room.flow_timeout_task.cancel()
+                room.flow_timeout_task = None
+            action = "resume"
+        else:
+            return
+            
+        logger.info(f"房间 {room.room_id} 转发流控: {action} (积压 {room.relay_backlog} 字节)")
+        if room.broadcaster_ws:
+            try:
+                await self._send(room.broadcaster_ws, {
+                    "type": "flow_control",
+                    "action": action
+                })
+            except Exception as e:
+                logger.error(f"发送流控信号失败: {e}")
+
+    async def _flow_pause_timeout(self, room: BroadcastRoom):
+        """暂停过久时，将仍有积压的观看者视为慢消费者，使主播能够恢复"""
+        await asyncio.sleep(FLOW_CONTROL_MAX_PAUSE)
+        room.flow_timeout_task = None
+        for viewer in room.viewers.values():
+            if viewer.queued_bytes:
+                self._mark_stalled(room, viewer)
+        await self._update_flow_control(room)
 
     async def _create_room(self, client_id: str, ws: WebSocketResponse):
         """创建直播房间"""
+        if client_id in self.client_to_room:
+            # 已在其他房间中，先离开原房间
+            await self._leave_room(client_id)
+            
         # 生成唯一的6位房间ID
-        room_id = generate_room_id()
-        while room_id in self.rooms:
-            room_id = generate_room_id()
+        try:
+            room_id = generate_room_id(self.rooms, self.shard, self.shards)
+        except RuntimeError as e:
+            await self._send(ws, {
+                "type": "error",
+                "message": str(e)
+            })
+            return
             
         room = BroadcastRoom(
             room_id=room_id,
@@ -261,15 +590,32 @@ class WebRTCSignalingServer:
         
         logger.info(f"房间创建: {room_id} by {client_id}")
         
-        await ws.send_json({
+        await self._send(ws, {
             "type": "room_created",
             "room_id": room_id
         })
 
     async def _join_room(self, client_id: str, ws: WebSocketResponse, room_id: str):
         """加入直播房间"""
+        if (self.shards > 1 and isinstance(room_id, str)
+                and room_id.isascii() and room_id.isdecimal()):
+            shard = int(room_id) % self.shards
+            if shard != self.shard:
+                # 房间由其他工作进程负责，让客户端重连到该进程的私有端口
+                port = shard_port(self.port, shard)
+                message = {"type": "redirect", "room_id": room_id, "port": port}
+                if self.redirect_url:
+                    message["url"] = self.redirect_url.format(shard=shard, port=port)
+                await self._send(ws, message)
+                return
+                
+        current = self.client_to_room.get(client_id)
+        if current and current != room_id:
+            # 已在其他房间中，先离开原房间
+            await self._leave_room(client_id)
+            
         if not room_id or room_id not in self.rooms:
-            await ws.send_json({
+            await self._send(ws, {
                 "type": "error",
                 "message": "房间不存在"
             })
@@ -277,27 +623,37 @@ class WebRTCSignalingServer:
             
         room = self.rooms[room_id]
         if not room.broadcaster_ws:
-            await ws.send_json({
+            await self._send(ws, {
                 "type": "error", 
                 "message": "主播已离开"
             })
             return
             
-        room.viewers[client_id] = ws
-        room.viewer_stats[client_id] = ViewerStats(client_id=client_id)
+        previous = room.viewers.get(client_id)
+        if previous:
+            # 重复加入：停止旧的发送协程并移除其积压
+            self._stop_writer(previous)
+            if not previous.stalled:
+                room.relay_backlog -= previous.queued_bytes
+            
+        viewer = Viewer(client_id=client_id, ws=ws, preframed=self._supports_preframed(ws))
+        room.viewers[client_id] = viewer
         self.client_to_room[client_id] = room_id
+        viewer.writer_task = asyncio.create_task(self._viewer_writer(room, viewer))
+        # 客户端可能在加入前已请求relay，或重复加入替换了旧的观看者对象
+        self._refresh_relay_viewers(room)
         
         logger.info(f"观看者 {client_id} 加入房间 {room_id}")
         
         # 通知观看者加入成功
-        await ws.send_json({
+        await self._send(ws, {
             "type": "room_joined",
             "room_id": room_id,
             "broadcaster_id": room.broadcaster_id
         })
         
         # 通知主播有新观看者
-        await room.broadcaster_ws.send_json({
+        await self._send(room.broadcaster_ws, {
             "type": "viewer_joined",
             "viewer_id": client_id,
             "viewer_count": len(room.viewers)
@@ -310,66 +666,123 @@ class WebRTCSignalingServer:
             return
             
         room = self.rooms[room_id]
+        # 先清理状态再发送通知：发送期间连接可能被取消
+        del self.client_to_room[client_id]
         
         if room.broadcaster_id == client_id:
             # 主播离开，关闭房间
-            for viewer_id, viewer_ws in room.viewers.items():
-                try:
-                    await viewer_ws.send_json({
-                        "type": "room_closed",
-                        "message": "主播已结束直播"
-                    })
-                except:
-                    pass
+            for viewer_id, viewer in room.viewers.items():
+                self._stop_writer(viewer)
+                self.client_to_room.pop(viewer_id, None)
+            if room.stats_flush_task:
+                room.stats_flush_task.cancel()
+                room.stats_flush_task = None
+            if room.flow_timeout_task:
+                room.flow_timeout_task.cancel()
+                room.flow_timeout_task = None
             del self.rooms[room_id]
             logger.info(f"房间关闭: {room_id}")
+            # shield: 主播断开时当前处理协程可能被取消，通知仍需送达
+            await asyncio.shield(self._broadcast(
+                [viewer.ws for viewer in room.viewers.values()],
+                {"type": "room_closed", "message": "主播已结束直播"}
+            ))
         else:
             # 观看者离开
-            if client_id in room.viewers:
-                del room.viewers[client_id]
-            if client_id in room.viewer_stats:
-                del room.viewer_stats[client_id]
+            viewer = room.viewers.pop(client_id, None)
+            if viewer:
+                self._stop_writer(viewer)
+                if not viewer.stalled:
+                    room.relay_backlog -= viewer.queued_bytes
             room.relay_connections.discard(client_id)
+            self._refresh_relay_viewers(room)
             
             if room.broadcaster_ws:
+                await self._update_flow_control(room)
                 try:
-                    await room.broadcaster_ws.send_json({
+                    await self._send(room.broadcaster_ws, {
                         "type": "viewer_left",
                         "viewer_id": client_id,
                         "viewer_count": len(room.viewers)
                     })
                 except:
                     pass
-                    
-        if client_id in self.client_to_room:
-            del self.client_to_room[client_id]
+
+    @staticmethod
+    def _refresh_relay_viewers(room: BroadcastRoom):
+        """重建relay观看者快照"""
+        room.relay_viewers = tuple(
+            room.viewers[vid] for vid in room.relay_connections if vid in room.viewers
+        )
+
+    @staticmethod
+    def _stop_writer(viewer: Viewer):
+        """停止观看者的发送协程"""
+        task = viewer.writer_task
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        viewer.writer_task = None
 
     async def _relay_signaling(self, client_id: str, data: dict):
         """转发信令消息"""
         target_id = data.get("target_id")
         room_id = self.client_to_room.get(client_id)
         
-        if not target_id or not room_id:
+        # 目标必须与发送方在同一房间
+        if not target_id or not room_id or self.client_to_room.get(target_id) != room_id:
             return
             
-        room = self.rooms.get(room_id)
-        if not room:
+        data["from_id"] = client_id
+        key = (client_id, target_id)
+        if data.get("type") == "ice_candidate":
+            # ICE候选在短时间窗口内合并转发
+            self._pending_ice.setdefault(key, []).append(data)
+            if not self._ice_flush_task:
+                self._ice_flush_task = asyncio.create_task(self._flush_ice())
             return
             
-        # 找到目标WebSocket
-        target_ws = None
-        if target_id == room.broadcaster_id:
-            target_ws = room.broadcaster_ws
-        elif target_id in room.viewers:
-            target_ws = room.viewers[target_id]
+        # 先发出同一方向上待合并的ICE候选，保持消息顺序
+        pending = self._pending_ice.pop(key, None)
+        if pending:
+            await self._send_ice(target_id, pending)
             
+        target_ws = self.websockets.get(target_id)
         if target_ws:
-            data["from_id"] = client_id
             try:
-                await target_ws.send_json(data)
+                await self._send(target_ws, data)
             except Exception as e:
                 logger.error(f"转发信令失败: {e}")
 
+    async def _flush_ice(self):
+        """等待合并窗口后转发所有待发送的ICE候选"""
+        await asyncio.sleep(ICE_BATCH_INTERVAL)
+        # 逐个方向取出后立即发送：发送期间到达的offer/answer会先取走对应方向的候选，
+        # 不会被排在更早的候选之前
+        while self._pending_ice:
+            (_, target_id), messages = self._pending_ice.popitem()
+            await self._send_ice(target_id, messages)
+        self._ice_flush_task = None
+
+    async def _send_ice(self, target_id: str, messages: List[dict]):
+        """转发ICE候选，多个候选合并为一条ice_candidates消息"""
+        target_ws = self.websockets.get(target_id)
+        if not target_ws:
+            return
+            
+        if len(messages) == 1:
+            data = messages[0]
+        else:
+            data = {
+                "type": "ice_candidates",
+                "from_id": messages[0]["from_id"],
+                "target_id": target_id,
+                "candidates": [m.get("candidate") for m in messages]
+            }
+        try:
+            await self._send(target_ws, data)
+        except Exception as e:
+            logger.error(f"转发信令失败: {e}")
+
     async def _update_stats(self, client_id: str, data: dict):
         """更新统计信息"""
         room_id = self.client_to_room.get(client_id)
@@ -381,33 +794,53 @@ class WebRTCSignalingServer:
         if room.broadcaster_id == client_id:
             # 主播更新统计
             room.current_bitrate = data.get("bitrate", 0)
-            
-            # 发送统计汇总给主播
-            stats = {
-                "type": "stats_summary",
-                "viewer_count": len(room.viewers),
-                "total_bytes_sent": room.total_bytes_sent,
-                "current_bitrate": room.current_bitrate,
-                "viewers": []
-            }
-            
-            for vid, vstat in room.viewer_stats.items():
-                stats["viewers"].append({
-                    "id": vid,
-                    "is_p2p": vstat.is_p2p,
-                    "bytes_sent": vstat.bytes_sent,
-                    "connected_duration": time.time() - vstat.connected_at
-                })
-                
-            try:
-                await room.broadcaster_ws.send_json(stats)
-            except:
-                pass
         else:
             # 观看者更新统计
-            if client_id in room.viewer_stats:
-                room.viewer_stats[client_id].is_p2p = data.get("is_p2p", False)
-                room.viewer_stats[client_id].bytes_sent = data.get("bytes_received", 0)
+            viewer = room.viewers.get(client_id)
+            if viewer:
+                viewer.is_p2p = data.get("is_p2p", False)
+                viewer.bytes_sent = data.get("bytes_received", 0)
+                viewer.dirty = True
+                
+        # 合并发送统计汇总给主播
+        room.stats_dirty = True
+        if not room.stats_flush_task:
+            room.stats_flush_task = asyncio.create_task(self._flush_stats(room))
+
+    async def _flush_stats(self, room: BroadcastRoom):
+        """等待合并间隔后发送统计增量给主播（仅包含有变化的观看者）"""
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        room.stats_flush_task = None
+        if not room.stats_dirty or not room.broadcaster_ws:
+            return
+        room.stats_dirty = False
+        
+        now = time.time()
+        changed = []
+        for vid, viewer in room.viewers.items():
+            if not viewer.dirty:
+                continue
+            viewer.dirty = False
+            changed.append({
+                "id": vid,
+                "is_p2p": viewer.is_p2p,
+                "bytes_sent": viewer.bytes_sent,
+                "dropped_frames": viewer.dropped_frames,
+                "connected_duration": now - viewer.connected_at
+            })
+            
+        stats = {
+            "type": "stats_delta",
+            "viewer_count": len(room.viewers),
+            "total_bytes_sent": room.total_bytes_sent,
+            "current_bitrate": room.current_bitrate,
+            "changed": changed
+        }
+        
+        try:
+            await self._send(room.broadcaster_ws, stats)
+        except:
+            pass
 
     async def _enable_relay(self, client_id: str, room_id: str):
         """启用服务器转发模式"""
@@ -416,22 +849,25 @@ class WebRTCSignalingServer:
             
         room = self.rooms[room_id]
         room.relay_connections.add(client_id)
+        self._refresh_relay_viewers(room)
         
-        if client_id in room.viewer_stats:
-            room.viewer_stats[client_id].is_p2p = False
+        viewer = room.viewers.get(client_id)
+        if viewer:
+            viewer.is_p2p = False
+            viewer.dirty = True
             
         logger.info(f"客户端 {client_id} 启用服务器转发模式")
         
         # 通知客户端已切换到转发模式
-        if client_id in room.viewers:
-            await room.viewers[client_id].send_json({
+        if viewer:
+            await self._send(viewer.ws, {
                 "type": "relay_enabled",
                 "message": "已切换到服务器转发模式"
             })
             
             # 如果有编解码器配置，发送给新的relay客户端
             if room.codec_config:
-                await room.viewers[client_id].send_json({
+                await self._send(viewer.ws, {
                     "type": "codec_config",
                     **room.codec_config
                 })
@@ -455,16 +891,47 @@ class WebRTCSignalingServer:
         
         logger.info(f"房间 {room_id} 编解码器配置: {room.codec_config}")
         
-        # 转发给所有relay连接的观看者
-        for viewer_id in room.relay_connections:
-            if viewer_id in room.viewers:
-                try:
-                    await room.viewers[viewer_id].send_json({
-                        "type": "codec_config",
-                        **room.codec_config
-                    })
-                except Exception as e:
-                    logger.error(f"发送编解码器配置到 {viewer_id} 失败: {e}")
+        # 只序列化一次，并发转发给所有relay连接的观看者
+        targets = room.relay_viewers
+        results = await self._broadcast(
+            [viewer.ws for viewer in targets],
+            {"type": "codec_config", **room.codec_config}
+        )
+        failed = False
+        for viewer, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error(f"发送编解码器配置到 {viewer.client_id} 失败: {result}")
+                room.relay_connections.discard(viewer.client_id)
+                failed = True
+        if failed:
+            self._refresh_relay_viewers(room)
+
+    @staticmethod
+    async def _send(ws: WebSocketResponse, data: dict):
+        """按连接协商的子协议发送控制消息（JSON文本帧或msgpack二进制帧）"""
+        if ws.ws_protocol == MSGPACK_PROTOCOL:
+            await ws.send_bytes(msgspec.msgpack.encode(data))
+        else:
+            await ws.send_json(data, dumps=dumps)
+
+    async def _broadcast(self, sockets: Iterable[WebSocketResponse], data: dict) -> List:
+        """并发向多个连接发送同一控制消息，返回每个连接的发送结果（异常或None）
+
+        每种编码只序列化一次。
+        """
+        payload = None
+        packed = None
+        sends = []
+        for ws in sockets:
+            if ws.ws_protocol == MSGPACK_PROTOCOL:
+                if packed is None:
+                    packed = msgspec.msgpack.encode(data)
+                sends.append(ws.send_bytes(packed))
+                continue
+            if payload is None:
+                payload = dumps(data)
+            sends.append(ws.send_str(payload))
+        return await asyncio.gather(*sends, return_exceptions=True)
 
     async def _handle_disconnect(self, client_id: str):
         """处理客户端断开连接"""
@@ -476,9 +943,70 @@ class WebRTCSignalingServer:
     def run(self, host: str = "0.0.0.0", port: int = 8080):
         """启动服务器"""
         logger.info(f"启动WebRTC流媒体服务器: http://{host}:{port}")
-        web.run_app(self.app, host=host, port=port)
+        loop = None
+        if uvloop is not None:
+            loop = uvloop.new_event_loop()
+            logger.info("使用uvloop事件循环")
+        web.run_app(self.app, host=host, port=port, loop=loop)
+
+    def run_worker(self, host: str = "0.0.0.0"):
+        """作为多进程模式的工作进程启动"""
+        run = uvloop.run if uvloop is not None else asyncio.run
+        try:
+            run(self._serve_worker(host))
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve_worker(self, host: str):
+        """监听公共端口（SO_REUSEPORT，与其他工作进程共享）和本进程的私有端口"""
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, self.port, reuse_port=True).start()
+        private_port = shard_port(self.port, self.shard)
+        await web.TCPSite(runner, host, private_port).start()
+        logger.info(f"工作进程 {self.shard}/{self.shards} 已启动，私有端口 {private_port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+def _worker_main(shard: int, shards: int, host: str, port: int, debug: bool, redirect_url: str):
+    """工作进程入口"""
+    server = WebRTCSignalingServer(debug=debug, shard=shard, shards=shards, port=port,
+                                   redirect_url=redirect_url)
+    server.run_worker(host)
+
+
+def run_workers(workers: int, host: str = "0.0.0.0", port: int = 8080, debug: bool = False,
+                redirect_url: str = ""):
+    """多进程模式：启动多个工作进程，按房间ID分片
+
+    分片约定：房间 R 只存在于工作进程 int(R) % workers 中。所有进程通过
+    SO_REUSEPORT 共享公共端口，加入其他分片房间的客户端会收到 redirect，
+    改连目标进程的私有端口 port + 1 + shard（或 redirect_url 模板给出的地址）。
+    """
+    logger.info(f"启动WebRTC流媒体服务器: http://{host}:{port} ({workers} 个工作进程)")
+    processes = [
+        multiprocessing.Process(target=_worker_main, args=(i, workers, host, port, debug, redirect_url))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
 
 
 if __name__ == "__main__":
-    server = WebRTCSignalingServer()
-    server.run()
+    debug = os.environ.get("WEBRTC_DEBUG") == "1"
+    workers = int(os.environ.get("WEBRTC_WORKERS", "1"))
+    if workers > 1:
+        run_workers(workers, debug=debug,
+                    redirect_url=os.environ.get("WEBRTC_REDIRECT_URL", ""))
+    else:
+        server = WebRTCSignalingServer(debug=debug)
+        server.run()
@@ -12,6 +12,9 @@
 class WebRTCStreamingClient {
     constructor() {
         this.ws = null;
+        this.wsHost = location.host; // changed by server redirect in multi-worker mode
+        this.wsUrl = null; // full URL from server redirect, overrides wsHost
+        this.pendingJoinRoomId = null;
         this.clientId = null;
         this.roomId = null;
         this.isBroadcaster = false;
@@ -39,9 +42,11 @@ class WebRTCStreamingClient {
         };
         this.statsInterval = null;
         this.streamStartTime = null;
+        this.viewerStats = new Map(); // viewer id -> latest stats from stats_delta
 
         // Relay mode
         this.isRelayMode = false;
+        this.isRelayPaused = false; // server flow control (pause/resume)
         this.relayCanvas = null;
         this.relayCtx = null;
 
@@ -69,7 +74,7 @@ class WebRTCStreamingClient {
 
     connectWebSocket() {
         const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${location.host}/ws`;
+        const wsUrl = this.wsUrl || `${protocol}//${this.wsHost}/ws`;
 
         this.ws = new WebSocket(wsUrl);
 
@@ -110,6 +115,14 @@ class WebRTCStreamingClient {
                 this.clientId = data.client_id;
                 this.iceServers = data.ice_servers;
                 console.log('Client ID:', this.clientId);
+                if (this.pendingJoinRoomId) {
+                    this.send({ type: 'join_room', room_id: this.pendingJoinRoomId });
+                    this.pendingJoinRoomId = null;
+                }
+                break;
+
+            case 'redirect':
+                this.handleRedirect(data);
                 break;
 
             case 'room_created':
@@ -144,14 +157,25 @@ class WebRTCStreamingClient {
                 this.handleIceCandidate(data);
                 break;
 
-            case 'stats_summary':
-                this.handleStatsSummary(data);
+            case 'ice_candidates':
+                // Server batches candidates sent close together
+                data.candidates.forEach(candidate => {
+                    this.handleIceCandidate({ from_id: data.from_id, candidate });
+                });
+                break;
+
+            case 'stats_delta':
+                this.handleStatsDelta(data);
                 break;
 
             case 'relay_enabled':
                 this.showMessage('Switched to server relay mode', 'info');
                 break;
 
+            case 'flow_control':
+                this.handleFlowControl(data);
+                break;
+
             case 'codec_config':
                 // Received codec config for decoder
                 this.configureDecoder(data.codec, data.width, data.height);
@@ -296,6 +320,8 @@ class WebRTCStreamingClient {
         document.getElementById('broadcasterStats').style.display = 'block';
 
         this.streamStartTime = Date.now();
+        this.isRelayPaused = false;
+        this.frameCounter = 0;
         this.startStatsUpdate();
 
         this.showMessage(`Streaming started! Room ID: ${this.roomId}`, 'success');
@@ -319,7 +345,10 @@ class WebRTCStreamingClient {
 
         this.isBroadcaster = false;
         this.roomId = null;
+        this.isRelayPaused = false;
+        this.frameCounter = 0;
         this.stopStatsUpdate();
+        this.viewerStats.clear();
 
         document.getElementById('startBroadcastBtn').disabled = false;
         document.getElementById('stopBroadcastBtn').disabled = true;
@@ -350,6 +379,9 @@ class WebRTCStreamingClient {
         }
 
         document.getElementById('viewerCount').textContent = data.viewer_count;
+
+        this.viewerStats.delete(viewerId);
+        this.renderViewersList();
     }
 
     // ==================== Watch ====================
@@ -368,6 +400,21 @@ class WebRTCStreamingClient {
         });
     }
 
+    // Room is served by another server worker: reconnect there and join again
+    handleRedirect(data) {
+        if (data.url) {
+            console.log(`Room ${data.room_id} is on ${data.url}, reconnecting`);
+            this.wsUrl = data.url;
+        } else {
+            console.log(`Room ${data.room_id} is on port ${data.port}, reconnecting`);
+            this.wsHost = `${location.hostname}:${data.port}`;
+        }
+        this.pendingJoinRoomId = data.room_id;
+        this.ws.onclose = null;
+        this.ws.close();
+        this.connectWebSocket();
+    }
+
     handleRoomJoined(data) {
         this.roomId = data.room_id;
         this.isBroadcaster = false;
@@ -582,6 +629,18 @@ class WebRTCStreamingClient {
         });
     }
 
+    // Server relay backlog too large: stop sending frames until resumed
+    handleFlowControl(data) {
+        if (data.action === 'pause') {
+            this.isRelayPaused = true;
+        } else if (data.action === 'resume') {
+            this.isRelayPaused = false;
+            // Frames were skipped, restart from a keyframe
+            this.frameCounter = 0;
+        }
+        console.log('Relay flow control:', data.action);
+    }
+
     // Init WebCodecs encoder (broadcaster)
     async initVideoEncoder() {
         if (!('VideoEncoder' in window)) {
@@ -753,6 +812,12 @@ class WebRTCStreamingClient {
             if (!this.isBroadcasting() || !this.isEncoderReady) return;
             if (this.videoEncoder.state !== 'configured') return;
 
+            const frameInterval = 1000 / this.encoderConfig.framerate;
+            if (this.isRelayPaused) {
+                setTimeout(encodeFrame, frameInterval);
+                return;
+            }
+
             const width = video.videoWidth || this.encoderConfig.width;
             const height = video.videoHeight || this.encoderConfig.height;
 
@@ -778,7 +843,6 @@ class WebRTCStreamingClient {
                 console.warn('Failed to encode frame:', e);
             }
 
-            const frameInterval = 1000 / this.encoderConfig.framerate;
             setTimeout(encodeFrame, frameInterval);
         };
 
@@ -800,6 +864,10 @@ class WebRTCStreamingClient {
 
         const sendFrame = () => {
             if (!this.isBroadcasting()) return;
+            if (this.isRelayPaused) {
+                setTimeout(sendFrame, 1000 / quality.frameRate);
+                return;
+            }
 
             canvas.width = video.videoWidth || quality.width;
             canvas.height = video.videoHeight || quality.height;
@@ -989,20 +1057,32 @@ class WebRTCStreamingClient {
         }
     }
 
-    handleStatsSummary(data) {
+    // Server only sends viewers changed since the last delta
+    handleStatsDelta(data) {
         document.getElementById('viewerCount').textContent = data.viewer_count;
         document.getElementById('currentBitrate').textContent = data.current_bitrate || 0;
         document.getElementById('totalSent').textContent = ((data.total_bytes_sent || 0) / 1024 / 1024).toFixed(2);
 
+        const now = Date.now();
+        (data.changed || []).forEach(viewer => {
+            viewer.receivedAt = now;
+            this.viewerStats.set(viewer.id, viewer);
+        });
+
+        this.renderViewersList();
+    }
+
+    renderViewersList() {
         const viewersList = document.getElementById('viewersList');
         viewersList.innerHTML = '';
 
-        if (data.viewers && data.viewers.length > 0) {
-            data.viewers.forEach(viewer => {
+        if (this.viewerStats.size > 0) {
+            const now = Date.now();
+            this.viewerStats.forEach(viewer => {
                 const div = document.createElement('div');
                 div.className = 'viewer-item';
 
-                const duration = Math.floor(viewer.connected_duration);
+                const duration = Math.floor(viewer.connected_duration + (now - viewer.receivedAt) / 1000);
                 const minutes = Math.floor(duration / 60);
                 const seconds = duration % 60;
 